@@ -150,6 +150,9 @@ def main():
                         help=("Generate a text file list of artifact paths. "
                               "This argument is meant to be used alone, without any other arguments."))
     parser.add_argument('--custom_output_folder', required=False, action="store", help="Custom name for the output folder")
+    parser.add_argument('--search_cache', required=False, action="store_true",
+                        help=("Reuse the file searches of earlier runs over the same unchanged input, "
+                              "cached in a folder private to the current user."))
 
     loader = plugin_loader.PluginLoader()
     available_plugins = list(loader.plugins)
@@ -292,13 +295,16 @@ def main():
     
     initialize_lava(input_path, out_params.report_folder_base, extracttype)
 
-    crunch_artifacts(selected_plugins, extracttype, input_path, out_params, wrap_text, loader, casedata, profile_filename)
+    search_cache_folder = default_search_cache_folder() if args.search_cache else None
+
+    crunch_artifacts(selected_plugins, extracttype, input_path, out_params, wrap_text, loader, casedata, profile_filename,
+                     search_cache_folder)
 
     lava_finalize_output(out_params.report_folder_base)
 
 def crunch_artifacts(
         plugins: typing.Sequence[plugin_loader.PluginSpec], extracttype, input_path, out_params, wrap_text,
-        loader: plugin_loader.PluginLoader, casedata, profile_filename):
+        loader: plugin_loader.PluginLoader, casedata, profile_filename, search_cache_folder=None):
     start = process_time()
     start_wall = perf_counter()
  
@@ -314,13 +320,13 @@ def crunch_artifacts(
     seeker = None
     try:
         if extracttype == 'fs':
-            seeker = FileSeekerDir(input_path, out_params.data_folder)
+            seeker = FileSeekerDir(input_path, out_params.data_folder, search_cache_folder)
 
         elif extracttype in ('tar', 'gz'):
-            seeker = FileSeekerTar(input_path, out_params.data_folder)
+            seeker = FileSeekerTar(input_path, out_params.data_folder, search_cache_folder)
 
         elif extracttype == 'zip':
-            seeker = FileSeekerZip(input_path, out_params.data_folder)
+            seeker = FileSeekerZip(input_path, out_params.data_folder, search_cache_folder)
 
         else:
             logfunc('Error on argument -o (input type)')
@@ -390,6 +396,7 @@ def crunch_artifacts(
             logfunc(f"No file found")
         logfunc('{} [{}] artifact completed'.format(plugin.name, plugin.module_name))
     log.close()
+    seeker.cleanup()
 
     write_device_info()
     logfunc('')
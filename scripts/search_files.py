@@ -1,18 +1,134 @@
 import time as timex
+import ctypes
+import hashlib
+import json
 import os
+import re
 import tarfile
+import stat
 import struct
 
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from scripts.ilapfuncs import *
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
 from zipfile import ZipFile
 
-from fnmatch import _compile_pattern
+from fnmatch import translate
 from functools import lru_cache
-normcase = lru_cache(maxsize=None)(os.path.normcase)
+from itertools import compress, islice, repeat
+from operator import contains
+from os.path import normcase
+
+def split_literal_prefix(pattern):
+    '''Returns (literal, pattern) where literal is the part of the glob pattern
+       before its first wildcard, every match must start with it'''
+    for index, char in enumerate(pattern):
+        if char in '*?[':
+            return pattern[:index], pattern
+    return pattern, pattern
+
+def _fnmatch_regex(pattern):
+    '''fnmatch.translate without its (?s:...) and end anchor wrapper'''
+    regex = translate(pattern)
+    return regex[len('(?s:'):regex.rindex(')')]
+
+def translate_with_doublestar(pattern):
+    '''Translates a glob pattern to a regular expression for re.fullmatch with re.DOTALL.
+       Everything but **/ is translated by fnmatch, so * and ? also match across folders,
+       while **/ matches any number of folders, including none'''
+    sep = re.escape(normcase('/'))
+    segments = re.split(r'\*\*+' + sep, pattern)
+    return ('(?:.*' + sep + ')?').join(_fnmatch_regex(segment) for segment in segments)
+
+def _required_literal(pattern):
+    '''Returns the longest run of literal characters that every match of the glob
+       pattern contains, character sets and anything after them are left out'''
+    sep = normcase('/')
+    chunks = re.split(r'[*?]+', pattern.split('[', 1)[0])
+    # the separator after ** is optional
+    return max((chunk.lstrip(sep) for chunk in chunks), key=len)
+
+def _key_pattern(filepattern):
+    '''Patterns are written against "root/" + path, this returns the glob that
+       matches the index key alone in the same way, or None for patterns that
+       can only be matched with the root added'''
+    pattern = normcase(filepattern)
+    root = normcase("root/")
+    sep = normcase("/")
+    if pattern.startswith(root):
+        return pattern[len(root):]
+    rest = pattern.lstrip('*')
+    if rest != pattern and rest.startswith(sep):
+        # a leading */ matches the injected root and optionally any folders below it
+        return '**' + rest
+    return None
+
+@lru_cache(maxsize=1024)
+def _compile_search_pattern(filepattern):
+    '''Returns (prefix, needle, match) for filepattern. match takes an index key,
+       prefix is the literal start and needle a substring every matching key has'''
+    key_pattern = _key_pattern(filepattern)
+    if key_pattern is not None:
+        match = re.compile(translate_with_doublestar(key_pattern), re.DOTALL).fullmatch
+        return split_literal_prefix(key_pattern)[0], _required_literal(key_pattern), match
+    match = re.compile(translate_with_doublestar(normcase(filepattern)), re.DOTALL).fullmatch
+    root = normcase("root/")
+    return '', '', lambda key: match(root + key)
+
+_FILE_ATTRIBUTE_NORMAL = 0x80
+
+def _fast_copy(src, dst, src_stat):
+    '''Copies src to dst, with CopyFileW on Windows so the data does not pass
+       through Python, otherwise with copyfile (which uses sendfile on Linux)'''
+    if stat.S_ISREG(src_stat.st_mode) and is_platform_windows():
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.CopyFileW(src, dst, False):
+            # CopyFileW also copies attributes, a read-only or hidden original
+            # must not leave its copy in the report read-only or hidden
+            kernel32.SetFileAttributesW(dst, _FILE_ATTRIBUTE_NORMAL)
+            return
+    copyfile(src, dst)
+
+# bump whenever a change to pattern matching could change which files a pattern finds,
+# so searches cached by an older version are not reused
+_SEARCH_CACHE_VERSION = 2
+_SEARCH_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+def default_search_cache_folder():
+    '''Returns the per-user folder the search cache is kept in'''
+    if is_platform_windows():
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ALEAPP', 'search_cache')
+
+def _is_private_folder(folder):
+    '''Creates folder if needed, returns False if other users could write to it'''
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if is_platform_windows():
+        return True # under the user profile, which is private by default
+    folder_stat = os.stat(folder)
+    return folder_stat.st_uid == os.getuid() and not folder_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _valid_cached_matches(matches, index_size):
+    '''Checks that a loaded cache maps patterns to positions that exist in the index'''
+    return isinstance(matches, dict) and all(
+        isinstance(pattern, str) and isinstance(found, list)
+        and all(type(index) is int and 0 <= index < index_size for index in found)
+        for pattern, found in matches.items())
+
+def _prune_cache_folder(folder):
+    '''Deletes cache files that have not been written for _SEARCH_CACHE_MAX_AGE'''
+    oldest = timex.time() - _SEARCH_CACHE_MAX_AGE
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.json') and entry.is_file() and entry.stat().st_mtime < oldest:
+            os.remove(entry.path)
 
 class FileInfo:
+    __slots__ = ('source_path', 'creation_date', 'modification_date')
+
     def __init__(self, source_path, creation_date, modification_date):
         self.source_path = source_path
         self.creation_date = creation_date
@@ -20,35 +136,126 @@ class FileInfo:
 
 class FileSeekerBase:
     # This is an abstract base class
+    def __init__(self, cache_folder=None):
+        self._match_keys = []
+        self._matches = {}
+        self._cache_folder = cache_folder
+        self._cache_path = None
+        self._index_digest = None
+        self._dirs_made = set()
+
     def search(self, filepattern_to_search, return_on_first_hit=False):
         '''Returns a list of paths for files/folders that matched'''
         pass
 
     def cleanup(self):
         '''close any open handles'''
-        pass
+        self._save_cache()
+
+    def _build_index(self, items, names):
+        '''Sets _match_keys to the sorted match keys of names, returns items in the same order'''
+        keys = [normcase(name) for name in names]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._match_keys = [keys[i] for i in order]
+        return [items[i] for i in order]
+
+    def _candidates(self, prefix):
+        '''Returns the (lo, hi) range of _match_keys that start with prefix'''
+        if not prefix:
+            return 0, len(self._match_keys)
+        lo = bisect_left(self._match_keys, prefix)
+        hi = bisect_left(self._match_keys, prefix + '\U0010ffff', lo)
+        return lo, hi
+
+    def _makedirs(self, folder):
+        '''os.makedirs for folders this seeker has not already created'''
+        if folder not in self._dirs_made:
+            os.makedirs(folder, exist_ok=True)
+            self._dirs_made.add(folder)
+
+    def _find(self, filepattern, return_on_first_hit=False, force=False):
+        '''Returns the positions in the index of the entries that match filepattern'''
+        if filepattern in self._matches and not force:
+            found = self._matches[filepattern]
+            return found[:1] if return_on_first_hit else found
+        prefix, needle, pat = _compile_search_pattern(filepattern)
+        lo, hi = self._candidates(prefix)
+        keys = self._match_keys
+        # map/compress keep the loops over the index in C, a substring test
+        # on the required literal leaves few keys for the regex to check
+        if needle:
+            candidates = compress(range(lo, hi), map(contains, keys[lo:hi], repeat(needle)))
+            hits = (index for index in candidates if pat(keys[index]) is not None)
+        else:
+            hits = compress(range(lo, hi), map(pat, keys[lo:hi]))
+        if return_on_first_hit:
+            return list(islice(hits, 1))
+        found = list(hits)
+        self._matches[filepattern] = found
+        return found
+
+    def _load_cache(self, source_path):
+        '''Loads the pattern matches saved by a previous run over the same, unchanged, source'''
+        if not self._cache_folder:
+            return
+        try:
+            if not _is_private_folder(self._cache_folder):
+                logfunc(f'Search cache folder {self._cache_folder} is not private to this user, not using it')
+                return
+            cache_key = f'{_SEARCH_CACHE_VERSION}|{os.path.abspath(source_path)}|{os.stat(source_path).st_mtime}'
+            cache_name = hashlib.sha1(cache_key.encode('utf-8', 'surrogatepass')).hexdigest() + '.json'
+            self._cache_path = os.path.join(self._cache_folder, cache_name)
+            digest = hashlib.sha1()
+            for key in self._match_keys:
+                digest.update(key.encode('utf-8', 'surrogatepass') + b'\0')
+            self._index_digest = digest.hexdigest()
+            if os.path.exists(self._cache_path):
+                with open(self._cache_path, 'r', encoding='utf-8') as cache_file:
+                    cache = json.load(cache_file)
+                # the index itself is compared too, as the mtime of a folder misses changes deeper down
+                if (cache.get('version') == _SEARCH_CACHE_VERSION and cache.get('index') == self._index_digest
+                        and _valid_cached_matches(cache.get('matches'), len(self._match_keys))):
+                    self._matches = cache['matches']
+                    logfunc(f'Loaded {len(self._matches)} cached searches for {source_path}')
+        except Exception as ex:
+            logfunc(f'Could not load search cache for {source_path} ' + str(ex))
+
+    def _save_cache(self):
+        '''Saves the pattern matches so a later run over the same source can skip them'''
+        if not self._cache_path or not self._matches:
+            return
+        try:
+            with open(self._cache_path, 'w', encoding='utf-8') as cache_file:
+                json.dump({'version': _SEARCH_CACHE_VERSION, 'index': self._index_digest, 'matches': self._matches}, cache_file)
+            _prune_cache_folder(self._cache_folder)
+        except Exception as ex:
+            logfunc(f'Could not save search cache to {self._cache_path} ' + str(ex))
 
 class FileSeekerDir(FileSeekerBase):
-    def __init__(self, directory, data_folder):
-        FileSeekerBase.__init__(self)
+    def __init__(self, directory, data_folder, cache_folder=None):
+        FileSeekerBase.__init__(self, cache_folder)
         self.directory = directory
         self._all_files = []
         self.data_folder = data_folder
         logfunc('Building files listing...')
         self.build_files_list(directory)
         logfunc(f'File listing complete - {len(self._all_files)} files')
+        self._all_files = self._build_index(self._all_files, self._all_files)
+        self._load_cache(directory)
         self.searched = {}
         self.copied = {}
         self.file_infos = {}        
 
     def build_files_list(self, directory):
         '''Populates all paths in directory into _all_files'''
+        def on_error(ex):
+            logfunc(f'Error reading {ex.filename} ' + str(ex))
+
         try:
-            files_list = os.scandir(directory)
-            for item in files_list:
-                self._all_files.append(item.path)
-                if item.is_dir(follow_symlinks=False):
-                    self.build_files_list(item.path)
+            for dir_path, dir_names, file_names in os.walk(directory, onerror=on_error):
+                # folders are kept in the listing as artifacts may search for them too
+                self._all_files.extend([os.path.join(dir_path, name) for name in dir_names])
+                self._all_files.extend([os.path.join(dir_path, name) for name in file_names])
         except Exception as ex:
             logfunc(f'Error reading {directory} ' + str(ex))
 
@@ -57,40 +264,54 @@ class FileSeekerDir(FileSeekerBase):
             pathlist = self.searched[filepattern]
             return self.searched[filepattern][0] if return_on_first_hit and pathlist else pathlist
         pathlist = []
-        pat = _compile_pattern( normcase(filepattern) )
-        root = normcase("root/")
-        for item in self._all_files:
-            if pat( root + normcase(item) ) is not None:
-                item_rel_path = item.replace(self.directory, '')
-                data_path = os.path.join(self.data_folder, item_rel_path[1:])
-                if is_platform_windows():
-                    data_path = data_path.replace('/', '\\')
-                if item not in self.copied or force:
-                    try:
-                        os.makedirs(os.path.dirname(data_path), exist_ok=True)
-                        copyfile(item, data_path)
-                        self.copied[item] = data_path
-                        creation_date = Path(item).stat().st_ctime
-                        modification_date = Path(item).stat().st_mtime
-                        file_info = FileInfo(item, creation_date, modification_date)
-                        self.file_infos[data_path] = file_info
-                    except Exception as ex:
-                        logfunc(f'Could not copy {item} to {data_path} ' + str(ex))
-                else:
-                    data_path = self.copied[item]
-                pathlist.append(data_path)
-                if return_on_first_hit:
-                    self.searched[filepattern] = pathlist
-                    return data_path
+        to_copy = []
+        for index in self._find(filepattern, return_on_first_hit, force):
+            item = self._all_files[index]
+            item_rel_path = item.replace(self.directory, '')
+            data_path = os.path.join(self.data_folder, item_rel_path[1:])
+            if is_platform_windows():
+                data_path = data_path.replace('/', '\\')
+            if item not in self.copied or force:
+                to_copy.append((item, data_path))
+            else:
+                data_path = self.copied[item]
+            pathlist.append(data_path)
+        if len(to_copy) > 1:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(self._copy_file, *zip(*to_copy)))
+        else:
+            results = [self._copy_file(item, data_path) for item, data_path in to_copy]
+        # bookkeeping and logging stay on this thread, logfunc may write to the GUI
+        for (item, data_path), (file_info, error) in zip(to_copy, results):
+            if error is None:
+                self.copied[item] = data_path
+                self.file_infos[data_path] = file_info
+            else:
+                logfunc(f'Could not copy {item} to {data_path} ' + error)
         self.searched[filepattern] = pathlist
+        if return_on_first_hit and pathlist:
+            return pathlist[0]
         return pathlist
 
+    def _copy_file(self, item, data_path):
+        '''Copies item to data_path, returns (FileInfo, None) or (None, error message)'''
+        try:
+            self._makedirs(os.path.dirname(data_path))
+            item_stat = os.stat(item)
+            _fast_copy(item, data_path, item_stat)
+            return FileInfo(item, item_stat.st_ctime, item_stat.st_mtime), None
+        except Exception as ex:
+            return None, str(ex)
+
 class FileSeekerTar(FileSeekerBase):
-    def __init__(self, tar_file_path, data_folder):
-        FileSeekerBase.__init__(self)
+    def __init__(self, tar_file_path, data_folder, cache_folder=None):
+        FileSeekerBase.__init__(self, cache_folder)
         self.is_gzip = tar_file_path.lower().endswith('gz')
         mode ='r:gz' if self.is_gzip else 'r'
         self.tar_file = tarfile.open(tar_file_path, mode)
+        members = self.tar_file.getmembers()
+        self._members = self._build_index(members, [member.name for member in members])
+        self._load_cache(tar_file_path)
         self.data_folder = data_folder
         self.searched = {}
         self.copied = {}
@@ -101,46 +322,59 @@ class FileSeekerTar(FileSeekerBase):
             pathlist = self.searched[filepattern]
             return self.searched[filepattern][0] if return_on_first_hit and pathlist else pathlist
         pathlist = []
-        pat = _compile_pattern( normcase(filepattern) )
-        root = normcase("root/")
-        for member in self.tar_file.getmembers():
-            if pat( root + normcase(member.name) ) is not None:
-                clean_name = sanitize_file_path(member.name)
-                full_path = os.path.join(self.data_folder, Path(clean_name))
-                if member.name not in self.copied or force:
-                    try:
-                        if member.isdir():
-                            os.makedirs(full_path, exist_ok=True)
-                        else:
-                            parent_dir = os.path.dirname(full_path)
-                            if not os.path.exists(parent_dir):
-                                os.makedirs(parent_dir)
-                            with open(full_path, "wb") as fout:
-                                fout.write(tarfile.ExFileObject(self.tar_file, member).read())
-                                fout.close()
-                                file_info = FileInfo(member.name, 0, member.mtime)
-                                self.file_infos[full_path] = file_info
-                                self.copied[member.name] = full_path
-                            os.utime(full_path, (member.mtime, member.mtime))
-                    except Exception as ex:
-                        logfunc(f'Could not write file to filesystem, path was {member.name} ' + str(ex))
-                else:
-                    full_path = self.copied[member.name]
-                pathlist.append(full_path)
-                if return_on_first_hit:
-                    self.searched[filepattern] = pathlist
-                    return full_path
+        for index in self._find(filepattern, return_on_first_hit, force):
+            member = self._members[index]
+            clean_name = sanitize_file_path(member.name)
+            full_path = os.path.join(self.data_folder, Path(clean_name))
+            if member.name not in self.copied or force:
+                try:
+                    if member.isdir():
+                        self._makedirs(full_path)
+                    else:
+                        self._makedirs(os.path.dirname(full_path))
+                        with open(full_path, "wb") as fout, tarfile.ExFileObject(self.tar_file, member) as fin:
+                            copyfileobj(fin, fout, 1 << 20)
+                            file_info = FileInfo(member.name, 0, member.mtime)
+                            self.file_infos[full_path] = file_info
+                            self.copied[member.name] = full_path
+                        os.utime(full_path, (member.mtime, member.mtime))
+                except Exception as ex:
+                    logfunc(f'Could not write file to filesystem, path was {member.name} ' + str(ex))
+            else:
+                full_path = self.copied[member.name]
+            pathlist.append(full_path)
+            if return_on_first_hit:
+                self.searched[filepattern] = pathlist
+                return full_path
         self.searched[filepattern] = pathlist
         return pathlist
 
     def cleanup(self):
         self.tar_file.close()
+        FileSeekerBase.cleanup(self)
+
+# extended timestamp (0x5455) extra field parts, flags are followed by the times they announce
+_ZIP_EXTRA_HEADER = struct.Struct('<HH')
+_ZIP_TS_FLAGS = struct.Struct('<B')
+_ZIP_TS_ONE = struct.Struct('<BI')
+_ZIP_TS_TWO = struct.Struct('<BII')
 
 class FileSeekerZip(FileSeekerBase):
-    def __init__(self, zip_file_path, data_folder):
-        FileSeekerBase.__init__(self)
+    def __init__(self, zip_file_path, data_folder, cache_folder=None):
+        FileSeekerBase.__init__(self, cache_folder)
         self.zip_file = ZipFile(zip_file_path)
-        self.name_list = self.zip_file.namelist()
+        self._meta = {}
+        for info in self.zip_file.infolist():
+            if info.filename.startswith("__MACOSX"):
+                continue
+            try:
+                timestamps = self.decode_extended_timestamp(info.extra)
+            except struct.error:
+                timestamps = (None, None)
+            self._meta[info.filename] = (timestamps, info.date_time)
+        names = list(self._meta)
+        self._names = self._build_index(names, names)
+        self._load_cache(zip_file_path)
         self.data_folder = data_folder
         self.searched = {}
         self.copied = {}
@@ -151,19 +385,18 @@ class FileSeekerZip(FileSeekerBase):
         length = len(extra_data)
 
         while offset < length:
-            header_id, data_size = struct.unpack_from('<HH', extra_data, offset)
+            header_id, data_size = _ZIP_EXTRA_HEADER.unpack_from(extra_data, offset)
             offset += 4
             if header_id == 0x5455:
-                creation_time = modification_time = None
-                flags = struct.unpack_from('B', extra_data, offset)[0]
-                offset += 1
+                flags, = _ZIP_TS_FLAGS.unpack_from(extra_data, offset)
+                if flags & 1 and flags & 4:  # Modification and creation time
+                    _, modification_time, creation_time = _ZIP_TS_TWO.unpack_from(extra_data, offset)
+                    return creation_time, modification_time
                 if flags & 1:  # Modification time
-                    modification_time, = struct.unpack_from('<I', extra_data, offset)
-                    offset += 4
+                    return None, _ZIP_TS_ONE.unpack_from(extra_data, offset)[1]
                 if flags & 4:  # Creation time
-                    creation_time, = struct.unpack_from('<I', extra_data, offset)
-                    offset += 4
-                return creation_time, modification_time
+                    return _ZIP_TS_ONE.unpack_from(extra_data, offset)[1], None
+                return None, None
             else:
                 offset += data_size
         return None, None
@@ -173,33 +406,28 @@ class FileSeekerZip(FileSeekerBase):
             pathlist = self.searched[filepattern]
             return self.searched[filepattern][0] if return_on_first_hit and pathlist else pathlist
         pathlist = []
-        pat = _compile_pattern( normcase(filepattern) )
-        root = normcase("root/")
-        for member in self.name_list:
-            if member.startswith("__MACOSX"):
-                continue
-            if pat( root + normcase(member) ) is not None:
-                if member not in self.copied or force:
-                    try:
-                        extracted_path = self.zip_file.extract(member, path=self.data_folder) # already replaces illegal chars with _ when exporting
-                        f = self.zip_file.getinfo(member)
-                        creation_date, modification_date = self.decode_extended_timestamp(f.extra)
-                        file_info = FileInfo(member, creation_date, modification_date)
-                        self.file_infos[extracted_path] = file_info
-                        date_time = f.date_time
-                        date_time = timex.mktime(date_time + (0, 0, -1))
-                        os.utime(extracted_path, (date_time, date_time))
-                        self.copied[member] = extracted_path
-                    except Exception as ex:
-                        logfunc(f'Could not write file to filesystem, path was {member} ' + str(ex))
-                else:
-                    extracted_path = self.copied[member]
-                pathlist.append(extracted_path)
-                if return_on_first_hit:
-                    self.searched[filepattern] = pathlist
-                    return extracted_path
+        for index in self._find(filepattern, return_on_first_hit, force):
+            member = self._names[index]
+            if member not in self.copied or force:
+                try:
+                    extracted_path = self.zip_file.extract(member, path=self.data_folder) # already replaces illegal chars with _ when exporting
+                    (creation_date, modification_date), date_time = self._meta[member]
+                    file_info = FileInfo(member, creation_date, modification_date)
+                    self.file_infos[extracted_path] = file_info
+                    date_time = timex.mktime(date_time + (0, 0, -1))
+                    os.utime(extracted_path, (date_time, date_time))
+                    self.copied[member] = extracted_path
+                except Exception as ex:
+                    logfunc(f'Could not write file to filesystem, path was {member} ' + str(ex))
+            else:
+                extracted_path = self.copied[member]
+            pathlist.append(extracted_path)
+            if return_on_first_hit:
+                self.searched[filepattern] = pathlist
+                return extracted_path
         self.searched[filepattern] = pathlist
         return pathlist
 
     def cleanup(self):
         self.zip_file.close()
+        FileSeekerBase.cleanup(self)